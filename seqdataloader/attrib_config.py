@@ -4,18 +4,18 @@ allowed_attributes['bigwig']={'dtype':'float32',
                                          'opener':open_bigwig_for_parsing,
                                          'parser':parse_bigwig_chrom_vals,
                                          'store_summits':False}
-allowed_attributes['bed_no_summit']={'dtype':'int',
+allowed_attributes['bed_no_summit']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':False,
                                'summit_from_peak_center':False}
-allowed_attributes['bed_summit_from_peak_center']={'dtype':'int',
+allowed_attributes['bed_summit_from_peak_center']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':True,
                                'summit_indicator':2,
                                'summit_from_peak_center':True}
-allowed_attributes['bed_summit_from_last_col']={'dtype':'int',
+allowed_attributes['bed_summit_from_last_col']={'dtype':'uint8',
                                'opener':open_csv_for_parsing,
                                'parser':parse_narrowPeak_chrom_vals,
                                'store_summits':True,
@@ -60,7 +60,7 @@ def get_attribute_info_from_file(attribute_config_file):
         attrib_info[field_name]=allowed_attributes[field_type]
     return attrib_info
 
-def get_attribute_info(attribute_config,attribute_config_file):
+def get_attribute_info(attribute_config,attribute_config_file=None):
     assert (attribute_config is None) or (attribute_config_file is None)
     if attribute_config_file is not None:
         return get_attribute_info_from_file(attribute_config_file) 
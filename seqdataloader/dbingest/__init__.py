@@ -9,26 +9,25 @@ from multiprocessing import Pool, Process, Queue
 import os
 import signal
 import tiledb
-import pickle
 import argparse
+import logging
 import pandas as pd
-import numpy as np
-from collections import OrderedDict
 from ..attrib_config import *
 from ..queue_config import * 
 from ..utils import *
 from ..tdb_config import * 
-import gc
 import time
 import sys
 
+logger=logging.getLogger(__name__)
+
 def args_object_from_args_dict(args_dict):
     #create an argparse.Namespace from the dictionary of inputs
     args_object=argparse.Namespace()
     #set the defaults
     vars(args_object)['overwrite']=False
     vars(args_object)['coord_tile_size']=10000
-    vars(args_boject)['task_tile_size']=1
+    vars(args_object)['task_tile_size']=1
     vars(args_object)['attribute_config']=None
     vars(args_object)['attribute_config_file']=None
     vars(args_object)['write_chunk']=30000000
@@ -76,8 +75,7 @@ def create_new_array(tdb_Context,
                      array_out_name,
                      coord_tile_size,
                      task_tile_size,
-                     attribute_config,
-                     attribute_config_file,
+                     attribute_info,
                      compressor='gzip',
                      compression_level=-1,
                      var=False):
@@ -91,32 +89,36 @@ def create_new_array(tdb_Context,
         name='genome_coordinate',
         domain=(0, size[0]),
         tile=coord_tile_size,
-        dtype='uint32')
+        dtype='uint32',
+        ctx=tdb_Context)
     tiledb_dim_tasks=tiledb.Dim(
         name='task',
         domain=(0,size[1]),#max([1,size[1]])),
         tile=task_tile_size,
-        dtype='uint32')
+        dtype='uint32',
+        ctx=tdb_Context)
     tiledb_dom = tiledb.Domain(tiledb_dim_coords,tiledb_dim_tasks,ctx=tdb_Context)
 
-    #generate the attribute information
-    attribute_info=get_attribute_info(attribute_config,attribute_config_file)
+    #attribute_info is parsed once by the caller; all attributes share one filter pipeline
+    attribute_filters=tiledb.FilterList([tiledb.BitShuffleFilter(ctx=tdb_Context),tiledb.GzipFilter(ctx=tdb_Context)],ctx=tdb_Context)
     attribs=[]
     for key in attribute_info:
         attribs.append(tiledb.Attr(
             name=key,
             var=var,
-            filters=tiledb.FilterList([tiledb.GzipFilter()]),
-            dtype=attribute_info[key]['dtype']))
+            filters=attribute_filters,
+            dtype=attribute_info[key]['dtype'],
+            ctx=tdb_Context))
     
     tiledb_schema = tiledb.ArraySchema(
         domain=tiledb_dom,
         attrs=tuple(attribs),
         cell_order='row-major',
-        tile_order='row-major')
+        tile_order='row-major',
+        ctx=tdb_Context)
     
-    tiledb.DenseArray.create(array_out_name, tiledb_schema)
-    print("created empty array on disk")
+    tiledb.DenseArray.create(array_out_name, tiledb_schema, ctx=tdb_Context)
+    logger.info("created empty array on disk")
     return
     
     
@@ -126,35 +128,46 @@ def extract_metadata_field(row,field):
     try:
         return row[field]
     except:
-        print("tiledb_metadata has no column "+field+" for dataset:"+str(dataset))
+        logger.warning("tiledb_metadata has no column "+field+" for dataset:"+str(dataset))
         return None
 
-def open_data_for_parsing(row,attribute_info):
+def get_data_paths_for_parsing(row,attribute_info):
+    '''
+    returns a dict of attribute -> file path for one row of the tiledb metadata; the files are opened by the
+    pool workers themselves (see open_data_for_parsing), so each worker reads through its own handles
+    '''
     try:
-        data_dict={}
-        cols=list(row.index)
+        data_paths={}
+        cols=list(row.keys())
         if 'dataset' in cols:
             cols.remove('dataset')
         for col in cols:
             cur_fname=extract_metadata_field(row,col)
             if isinstance(cur_fname,str):
                 assert os.path.exists(cur_fname), "The path:"+str(cur_fname)+" does not exist. If you meant to skip this column, leave it empty in the metadata sheet." 
-            elif math.isnan(float(cur_fname)):
+            elif cur_fname is None:
                 continue
-            elif cur_fname is  None:
+            elif math.isnan(float(cur_fname)):
                 continue
-            data_dict[col]=attribute_info[col]['opener'](cur_fname,parallel=True)
-        return data_dict
+            assert col in attribute_info, "The tiledb_metadata column:"+str(col)+" is not an attribute of the selected attribute config."
+            data_paths[col]=cur_fname
+        return data_paths
     except Exception as e:
-        print(repr(e))
+        logger.error(repr(e))
         kill_child_processes(os.getpid())
         raise
+
+def open_data_for_parsing(data_paths,attribute_info):
+    data_dict={}
+    for attribute in data_paths:
+        data_dict[attribute]=attribute_info[attribute]['opener'](data_paths[attribute])
+    return data_dict
     
 def ingest(args):
     if type(args)==type({}):
         args=args_object_from_args_dict(args)
     if args.write_chunk > max_write_chunk:
-        print("WARNING: You have specified a write_chunk size of"+str(args.write_chunk)+" but the maximum supported with python serialization is:"+str(max_write_chunk)+". It will be reset to "+str(max_write_chunk))
+        logger.warning("You have specified a write_chunk size of"+str(args.write_chunk)+" but the maximum supported with python serialization is:"+str(max_write_chunk)+". It will be reset to "+str(max_write_chunk))
         args.write_chunk=max_write_chunk
 
     #create a queue to write the array
@@ -162,45 +175,40 @@ def ingest(args):
     write_queue=Queue(maxsize=args.max_queue_size)
 
     #config
-    tdb_Config=tiledb.Config(tdb_config_params)
-    tdb_write_Context=tiledb.Ctx(config=tdb_Config)   
-    tdb_read_Context=tiledb.Ctx(config=tdb_Config)
+    tdb_Context=get_tdb_context()
     
     overwrite=args.overwrite
     coord_tile_size=args.coord_tile_size
     task_tile_size=args.task_tile_size
-    attribute_config=args.attribute_config
-    attribute_config_file=args.attribute_config_file
     updating=False
 
     attribute_info=get_attribute_info(args.attribute_config,args.attribute_config_file)
     tiledb_metadata=pd.read_csv(args.tiledb_metadata,header=0,sep='\t')
     num_tasks=tiledb_metadata.shape[0]
-    print("num_tasks:"+str(num_tasks))
+    logger.info("num_tasks:"+str(num_tasks))
     
-    print("loaded tiledb metadata")
+    logger.info("loaded tiledb metadata")
     chrom_sizes=pd.read_csv(args.chrom_sizes,header=None,sep='\t')
-    print("loaded chrom sizes")
+    logger.info("loaded chrom sizes")
     chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
-    print("num_indices:"+str(num_indices))
+    logger.info("num_indices:"+str(num_indices))
     array_out_name=args.array_name
-    if tiledb.object_type(array_out_name) == "array":
+    if tiledb.object_type(array_out_name,ctx=tdb_Context) == "array":
         if overwrite==False:
             raise Exception("array:"+str(array_out_name) + "already exists; use the --overwrite flag to overwrite it. Exiting")
         else:
-            print("warning: the array: "+str(array_out_name)+" already exists. You provided the --overwrite flag, so it will be updated/overwritten")
+            logger.warning("the array: "+str(array_out_name)+" already exists. You provided the --overwrite flag, so it will be updated/overwritten")
             updating=True
     else:
         #create the array:
-        create_new_array(tdb_Context=tdb_write_Context,
+        create_new_array(tdb_Context=tdb_Context,
                          size=(num_indices,num_tasks-1),
-                         attribute_config=attribute_config,
-                         attribute_config_file=attribute_config_file,
+                         attribute_info=attribute_info,
                          array_out_name=array_out_name,
                          coord_tile_size=coord_tile_size,
                          task_tile_size=task_tile_size,
                          var=False)
-        print("created new array:"+str(array_out_name))
+        logger.info("created new array:"+str(array_out_name))
         #create metadata array
         metadata_dict={}
         metadata_dict['tasks']=[i for i in tiledb_metadata['dataset']]
@@ -210,7 +218,7 @@ def ingest(args):
         num_tasks=tiledb_metadata['dataset'].shape[0]
         
         num_chroms=len(chrom_indices.keys())
-        with tiledb.DenseArray(array_out_name,ctx=tdb_write_Context,mode='w') as cur_array:
+        with tiledb.DenseArray(array_out_name,ctx=tdb_Context,mode='w') as cur_array:
             cur_array.meta['num_tasks']=num_tasks
             cur_array.meta['num_chroms']=num_chroms
             for task_index in range(num_tasks):
@@ -219,132 +227,126 @@ def ingest(args):
                 cur_array.meta['_'.join(['chrom',str(chrom_index)])]=metadata_dict['chroms'][chrom_index]
                 cur_array.meta['_'.join(['size',str(chrom_index)])]=metadata_dict['sizes'][chrom_index]
                 cur_array.meta['_'.join(['offset',str(chrom_index)])]=metadata_dict['offsets'][chrom_index]                                
-        print("created tiledb metadata")
-    pool=Pool(processes=args.threads,initializer=init_worker)
-    print("made pool") 
+        logger.info("created tiledb metadata")
+    #collect the data paths for all tasks before the pool is forked; workers inherit task_data_paths and look them up by
+    #task index, so no per-task data is pickled into every chunk's pool input
+    global task_data_paths
+    task_data_paths=[]
     pool_inputs=[] 
-    for task_index,task_row in tiledb_metadata.iterrows():
+    for task_index,task_row in enumerate(tiledb_metadata.to_dict(orient='records')):
         dataset=task_row['dataset']
         #read in filenames for bigwigs
-        data_dict=open_data_for_parsing(task_row,attribute_info)
+        task_data_paths.append(get_data_paths_for_parsing(task_row,attribute_info))
         for start_chunk_index in range(0,num_indices,args.write_chunk):
-            end_chunk_index=start_chunk_index+min([num_indices,args.write_chunk])
+            end_chunk_index=min([start_chunk_index+args.write_chunk,num_indices])
             #convert global indices to chrom+pos indices
             chunk_chrom_coords=transform_indices_to_chrom_coords(start_chunk_index,end_chunk_index,chrom_indices)
             if chunk_chrom_coords is None:
                 raise Exception("failed to tranform indices:"+str(start_chunk_index)+"-"+str(end_chunk_index)+ " to chrom coords;"+str(chrom_indices))
             for coord_set in chunk_chrom_coords:
-                pool_inputs.append((task_index,data_dict,attribute_info,coord_set,args))
-    pool_feed_chunk_start=0
-    pool_feed_chunk_max=len(pool_inputs)
+                pool_inputs.append((task_index,attribute_info,coord_set,args))
+    pool=Pool(processes=args.threads,initializer=init_worker,maxtasksperchild=max_tasks_per_child)
+    logger.debug("made pool") 
     chunks_to_process=len(pool_inputs)
-    array_writer=Process(target=write_array,args=([args,updating,chunks_to_process]))
+    array_writer=Process(target=write_array,args=([args,attribute_info,updating,chunks_to_process]))
     try:
         array_writer.start()
     except Exception as e:
         raise e
 
     try:
-        while pool_feed_chunk_start < pool_feed_chunk_max:
-            pool_feed_chunk_end=min([pool_feed_chunk_start+queue_feed_chunk_size,pool_feed_chunk_max])
-            #only do mapping if queue size is not exceeded & total memory consumption is not exceeded
-            write_queue_size=write_queue.qsize()
-            mem_used=psutil.virtual_memory().used / (10**9)
-            print("mapping to pool, queue size:"+str(write_queue_size))
-            print("mapping to pool, mem used:"+str(mem_used))
-            while (write_queue_size >=args.max_queue_size) or (mem_used >=args.max_mem_g):
-                time.sleep(10)
-            print("sending to pool:"+str(pool_feed_chunk_start)+"-"+str(pool_feed_chunk_end)+"/"+str(chunks_to_process))
-            pool.map(process_chunk,pool_inputs[pool_feed_chunk_start:pool_feed_chunk_end])
-            pool_feed_chunk_start+=queue_feed_chunk_size
-            time.sleep(60)
+        #no manual feeding is needed: the bounded write_queue blocks workers once max_queue_size parsed chunks are waiting
+        #for the writer, and process_chunk waits while memory use is above max_mem_g
+        #each chunk is parsed in a single task: a chunk already covers up to write_chunk bases, so batching saves no
+        #meaningful pickling and would only unbalance the tail of the run
+        logger.info("sending "+str(chunks_to_process)+" chunks to pool")
+        pool_result=pool.map_async(process_chunk,pool_inputs,chunksize=1)
+        #poll instead of blocking on the pool: if the writer dies, workers would otherwise block forever on the full
+        #write_queue, or finish and let the ingest report success over a failed write
+        while not pool_result.ready():
+            if (not array_writer.is_alive()) and (array_writer.exitcode!=0):
+                raise Exception("array writer exited with code "+str(array_writer.exitcode)+" before all chunks were written")
+            pool_result.wait(10)
+        #re-raises the first exception from a pool worker, if any
+        pool_result.get()
         pool.close()
-    except KeyboardInterrupt:
+    except BaseException as e:
+        #covers KeyboardInterrupt as well; make sure neither the writer nor any pool worker outlives the failure
+        logger.error(repr(e))
         kill_child_processes(os.getpid())
         pool.terminate()
         raise
-    except Exception as e:
-        print(e)
-        kill_child_processes(os.getpid())
-        raise 
+    finally:
+        logger.debug("shutting down pool")
+        pool.join()
         
     #wait until we're done writing to the tiledb array
     array_writer.join()
-    print("array_writer.join() is complete")
-    print("shutting down pool")
-    pool.join()
-    print('done!') 
+    logger.debug("array_writer.join() is complete")
+    if array_writer.exitcode!=0:
+        raise Exception("array writer exited with code "+str(array_writer.exitcode)+"; the array:"+str(array_out_name)+" was not fully written")
+    logger.info('done!') 
 
 def process_chunk(inputs):
     try:
         task_index=inputs[0]
-        data_dict=inputs[1]
-        attribute_info=inputs[2]
-        coord_set=inputs[3]
-        args=inputs[4]
+        attribute_info=inputs[1]
+        coord_set=inputs[2]
+        args=inputs[3]
+        #open the task's files in this worker; bigwig handles are cached per process, so each file is opened once per worker
+        data_dict=open_data_for_parsing(task_data_paths[task_index],attribute_info)
+        #don't parse another chunk while memory use is above the limit
+        while psutil.virtual_memory().used / (10**9) >= args.max_mem_g:
+            time.sleep(10)
 
-        attribute_config=args.attribute_config
-        dict_to_write=OrderedDict()
         chrom=coord_set[0]
         start_pos=coord_set[1]
         end_pos=coord_set[2]
         start_index=coord_set[3]
         end_index=coord_set[4] 
-        for attribute in data_dict:
-            cur_parser=attribute_info[attribute]['parser']
-            cur_vals=cur_parser([data_dict[attribute],chrom,start_pos,end_pos,attribute_info[attribute]])
-            dict_to_write[attribute]=cur_vals[-1] #the last entry in the tuple is the actual numpy array of values; the first entries store start and end blocks
-        payload=pickle.dumps([task_index,start_index,end_index,dict_to_write],pickle.HIGHEST_PROTOCOL)
-        write_queue.put(payload)
-        gc.collect()
+        #values come back in each attribute's dtype, so the queue pickles the narrower arrays and the writer hands them to tiledb without a cast
+        dict_to_write=parse_all_attributes(data_dict,chrom,start_pos,end_pos,attribute_info)
+        #the queue serializes the payload itself, so the numpy arrays are pickled exactly once on their way to the writer
+        write_queue.put((task_index,start_index,end_index,dict_to_write))
     except: 
         kill_child_processes(os.getpid())
         raise
 
-def write_array(args, updating, chunks_to_process):    
+def write_array(args, attribute_info, updating, chunks_to_process):    
     try:
         #config
-        tdb_Config=tiledb.Config(tdb_config_params)
-        tdb_write_Context=tiledb.Ctx(config=tdb_Config)   
-        
+        tdb_Context=get_tdb_context()
         if updating is True:
-            tdb_read_Context=tiledb.Ctx(config=tdb_Config)
-            cur_array_toread=tiledb.DenseArray(args.array_name,ctx=tdb_read_Context,mode='r')
-        cur_array_towrite=tiledb.DenseArray(args.array_name,ctx=tdb_write_Context,mode='w')
+            cur_array_toread=tiledb.DenseArray(args.array_name,ctx=tdb_Context,mode='r')
+            array_attribs=[cur_array_toread.schema.attr(i).name for i in range(cur_array_toread.schema.nattr)]
+        cur_array_towrite=tiledb.DenseArray(args.array_name,ctx=tdb_Context,mode='w')
         chunks_processed=0
         while chunks_processed < chunks_to_process:
-            while write_queue.empty() is True:
-                time.sleep(10)
-            processed_chunk=write_queue.get()
-            processed_chunk_unpickled=pickle.loads(processed_chunk)
-            task_index=processed_chunk_unpickled[0]
-            start_index=processed_chunk_unpickled[1]
-            end_index=processed_chunk_unpickled[2]
-            dict_to_write=processed_chunk_unpickled[3]
+            #blocks until a worker hands over the next parsed chunk
+            task_index,start_index,end_index,dict_to_write=write_queue.get()
             if updating is True:
-                #we are only updating some attributes in the array
-                cur_vals=cur_array_toread[start_index:end_index,task_index]            
-                #print("got cur vals for task "+str(task_index)+" for "+str(start_index)+":"+str(end_index))
-                for key in dict_to_write:
-                    cur_vals[key]=dict_to_write[key]
-                dict_to_write=cur_vals
-                print("updated data dict for writing:"+args.array_name) 
+                #we are only updating some attributes in the array. A dense write must still provide every attribute,
+                #so read back only the attributes we are not overwriting, and skip the read if all of them are provided
+                attribs_to_keep=[attrib for attrib in array_attribs if attrib not in dict_to_write]
+                if len(attribs_to_keep)>0:
+                    cur_vals=cur_array_toread.query(attrs=attribs_to_keep)[start_index:end_index,task_index]
+                    for attrib in attribs_to_keep:
+                        dict_to_write[attrib]=cur_vals[attrib]
+                logger.debug("updated data dict for writing:"+args.array_name) 
             else:
-                #we are writing for the first time, make sure all attributes are provided, if some are not, use a nan array
-                required_attrib=list(get_attribute_info(args.attribute_config,args.attribute_config_file).keys())
-                #print(str(required_attrib))
-                for attrib in required_attrib:
+                #we are writing for the first time, make sure all attributes are provided, if some are not, fill them with the attribute's missing value
+                for attrib in attribute_info:
                     if attrib not in dict_to_write:
-                        print("augmenting")
-                        dict_to_write[attrib]=np.full(end_index-start_index,np.nan)
+                        logger.debug("augmenting")
+                        dict_to_write[attrib]=get_missing_attribute_vals(end_index-start_index,attribute_info[attrib]['dtype'])
             #write in chunks
             cur_array_towrite[start_index:end_index,task_index]=dict_to_write
-            print('Gigs:', round(psutil.virtual_memory().used / (10**9), 2))
-            gc.collect()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Gigs:"+str(round(psutil.virtual_memory().used / (10**9), 2)))
             chunks_processed+=1
-            print("wrote to disk "+str(task_index)+" for "+str(start_index)+":"+str(end_index)+";"+str(chunks_processed)+"/"+str(chunks_to_process))
+            logger.debug("wrote to disk "+str(task_index)+" for "+str(start_index)+":"+str(end_index)+";"+str(chunks_processed)+"/"+str(chunks_to_process))
         assert chunks_processed >=chunks_to_process
-        print("closing arrays")
+        logger.debug("closing arrays")
         if updating is True:
             cur_array_toread.close()
         cur_array_towrite.close()
@@ -355,12 +357,13 @@ def write_array(args, updating, chunks_to_process):
         #try to delete all tmp files
         raise
     except Exception as e:
-        print(e)
+        logger.error(repr(e))
         kill_child_processes(os.getpid())
-        raise Exception(e.message) 
+        raise
 
     
 def main():
+    logging.basicConfig(level=logging.INFO,format="%(asctime)s %(levelname)s %(processName)s: %(message)s")
     args=parse_args()
     ingest(args)
         
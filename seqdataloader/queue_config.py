@@ -1,2 +1,2 @@
-queue_feed_chunk_size=50 #number of items to queue into pool at once for processing
 max_write_chunk=30000000
+max_tasks_per_child=4 #number of chunks a pool worker parses before it exits and is replaced, returning its heap to the OS (the pool maps one chunk per task)
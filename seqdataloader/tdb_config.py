@@ -1,8 +1,22 @@
+import os
+import tiledb
+
+#tiledb thread pools are capped at the number of cores, so the writer's internal threads do not oversubscribe
+#the machine on top of the parse pool running next to it
+tdb_num_threads=min([50,os.cpu_count() or 1])
 tdb_config_params={"sm.check_coord_dups":False,
                    "sm.check_coord_oob":False,
                    "sm.check_global_order":False,
-                   "sm.num_writer_threads":50,
-                   "sm.num_reader_threads":50,
-                   "sm.num_async_threads":50,
-                   "vfs.num_threads":50}
-#                   "sm.memory_budget":"5000000000"
+                   "sm.num_writer_threads":tdb_num_threads,
+                   "sm.num_reader_threads":tdb_num_threads,
+                   "sm.num_async_threads":tdb_num_threads,
+                   "vfs.num_threads":tdb_num_threads}
+
+#tiledb contexts spin up their own thread pools, so each process builds one on first use and reuses it.
+#contexts do not survive a fork, hence the cache is keyed by process id.
+tdb_contexts={}
+def get_tdb_context():
+    pid=os.getpid()
+    if pid not in tdb_contexts:
+        tdb_contexts[pid]=tiledb.Ctx(config=tiledb.Config(tdb_config_params))
+    return tdb_contexts[pid]
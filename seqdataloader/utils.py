@@ -1,3 +1,5 @@
+import os
+import logging
 import pandas as pd
 import numpy as np
 import pyBigWig
@@ -5,39 +7,77 @@ from pybedtools import BedTool
 from itertools import islice
 from collections import OrderedDict
 
-def open_bigwig_for_parsing(fname,parallel=False):
-    if not parallel:
-        return pyBigWig.open(fname)
-    else:
-        #pybigwig objects cannot be pickled
-        return fname 
-def open_csv_for_parsing(fname,parallel=False):
-    #if not parallel:
+logger=logging.getLogger(__name__)
+
+#pybigwig handles opened by this process, keyed by file name, so the file header and index are read once rather than
+#once per chunk. handles are never shared across a fork, hence the process id check. nothing is evicted automatically:
+#dbingest pool workers release their handles by exiting after max_tasks_per_child chunks, and long-lived processes
+#must call close_bigwig_handles() once they are done with a set of files.
+bigwig_handles={}
+bigwig_handles_pid=None
+def get_bigwig_handle(fname):
+    global bigwig_handles_pid
+    if bigwig_handles_pid!=os.getpid():
+        bigwig_handles.clear()
+        bigwig_handles_pid=os.getpid()
+    if fname not in bigwig_handles:
+        bigwig_handles[fname]=pyBigWig.open(fname)
+    return bigwig_handles[fname]
+
+def close_bigwig_handles():
+    if bigwig_handles_pid==os.getpid():
+        for fname in bigwig_handles:
+            bigwig_handles[fname].close()
+    bigwig_handles.clear()
+
+def open_bigwig_for_parsing(fname):
+    return get_bigwig_handle(fname)
+
+def open_csv_for_parsing(fname):
     return BedTool(fname)
-    #else:
-        #
-    #    return fname
+
+def expand_bigwig_intervals(intervals,start,end):
+    '''
+    expands the sorted, non-overlapping (start,end,value) intervals that pybigwig returns for chrom:start-end into
+    a dense float32 array of end-start values; bases not covered by any interval are 0.
+    '''
+    num_bases=end-start
+    #pybigwig returns None rather than an empty tuple when nothing in the range is covered
+    if not intervals:
+        return np.zeros(num_bases,dtype=np.float32)
+    num_intervals=len(intervals)
+    intervals=np.asarray(intervals)
+    interval_starts=np.clip(intervals[:,0].astype(np.int64)-start,0,num_bases)
+    interval_ends=np.clip(intervals[:,1].astype(np.int64)-start,0,num_bases)
+    #tag each base with an event id: 2i+1 from the start of interval i, 2i+2 from its end until the next interval starts.
+    #ids grow with position, so a running maximum carries each id forward over the bases it covers.
+    event_ids=np.zeros(num_bases+1,dtype=np.int32)
+    event_ids[interval_ends]=2*np.arange(num_intervals,dtype=np.int32)+2
+    event_ids[interval_starts]=2*np.arange(num_intervals,dtype=np.int32)+1
+    np.maximum.accumulate(event_ids,out=event_ids)
+    event_vals=np.zeros(2*num_intervals+1,dtype=np.float32)
+    event_vals[1::2]=np.nan_to_num(intervals[:,2])
+    return event_vals[event_ids[:num_bases]]
 
 def parse_bigwig_chrom_vals(entry):
     bigwig_object=entry[0]
     if type(bigwig_object)==str:
-        bigwig_object=pyBigWig.open(bigwig_object)
+        bigwig_object=get_bigwig_handle(bigwig_object)
     chrom=entry[1]
     start=entry[2]
     end=entry[3]
     cur_attribute_info=entry[4]
     #note: pybigwig uses NA in place of 0 where there are no reads, replace with 0.
-    bw_chroms=bigwig_object.chroms().keys()
-    if chrom not in bw_chroms:
-        print("WARNING: chromosome:"+str(chrom)+ " was not found in the bigwig file:"+str(bigwig_object))
-        size=(end-start+1)
-        signal_data=np.full(size,np.nan)
+    if bigwig_object.chroms(chrom) is None:
+        logger.warning("chromosome:"+str(chrom)+ " was not found in the bigwig file:"+str(bigwig_object))
+        signal_data=np.full(end-start,np.nan,dtype=np.float32)
     else: 
         #check to see if chromosome in bigwig, if not, return all NA's & warning that chromosome is not present in the dataset
         try:
-            signal_data=np.nan_to_num(bigwig_object.values(chrom,start,end))
+            #fetch the covered intervals and expand them in numpy rather than building a per-base python list with values()
+            signal_data=expand_bigwig_intervals(bigwig_object.intervals(chrom,start,end),start,end)
         except Exception as e:
-            print(chrom+"\t"+str(start)+"\t"+str(end)+str(cur_attribute_info))
+            logger.error(chrom+"\t"+str(start)+"\t"+str(end)+str(cur_attribute_info))
             raise e
     return start, end, signal_data
 
@@ -60,7 +100,7 @@ def parse_narrowPeak_chrom_vals(entry):
         if store_summits is True:
             summit_from_peak_center=cur_attribute_info['summit_from_peak_center'] 
             summit_indicator=cur_attribute_info['summit_indicator']
-    signal_data = np.zeros(num_entries, dtype=np.int)
+    signal_data = np.zeros(num_entries, dtype=np.uint8)
     warned=False
     summits=[]
     for entry in cur_bed:
@@ -77,16 +117,53 @@ def parse_narrowPeak_chrom_vals(entry):
                 try:
                     summit_pos=entry_start+int(entry[-1])
                 except:
-                    print("WARNING: could not add summit position from last column of narrowPeak file, falling back to peak center"+str(entry))
+                    logger.warning("could not add summit position from last column of narrowPeak file, falling back to peak center"+str(entry))
                     summit_pos=int(entry_start+(entry_end-entry_start)*0.5)                
             if (summit_pos < entry_end) and (summit_pos > entry_start):
                 summits.append(summit_pos)
             else:
-                print("WARNING: summit position outside peak region position,skipping:"+str(entry))                    
+                logger.warning("summit position outside peak region position,skipping:"+str(entry))                    
     if store_summits is True:
         signal_data[summits]=summit_indicator
     return start, end, signal_data 
     
+def parse_all_attributes(data_dict,chrom,start,end,attribute_info):
+    '''
+    parses chrom:start-end for every attribute in data_dict and returns an OrderedDict of attribute -> numpy array
+    in the attribute's dtype. Attributes that read the same source with the same parsing config (e.g. idr_peak and
+    overlap_peak pointing at one narrowPeak file) are parsed once and share the resulting array.
+    '''
+    parsed=dict()
+    attribute_vals=OrderedDict()
+    for attribute in data_dict:
+        cur_data=data_dict[attribute]
+        cur_attribute_info=attribute_info[attribute]
+        #file names and BedTool objects identify their source; other handles are only shared if they are the same object
+        source=cur_data if isinstance(cur_data,str) else getattr(cur_data,'fn',id(cur_data))
+        #key on the parser and the settings it reads, so equal configs dedupe even when they are separate dict objects
+        parse_key=(source,
+                   cur_attribute_info['parser'],
+                   str(np.dtype(cur_attribute_info['dtype'])),
+                   cur_attribute_info.get('store_summits'),
+                   cur_attribute_info.get('summit_from_peak_center'),
+                   cur_attribute_info.get('summit_indicator'))
+        if parse_key not in parsed:
+            cur_vals=cur_attribute_info['parser']([cur_data,chrom,start,end,cur_attribute_info])
+            #the last entry in the tuple is the actual numpy array of values; the first entries store start and end blocks
+            parsed[parse_key]=np.asarray(cur_vals[-1],dtype=cur_attribute_info['dtype'])
+        attribute_vals[attribute]=parsed[parse_key]
+    return attribute_vals
+
+def get_missing_attribute_vals(num_entries,dtype):
+    '''
+    values stored for an attribute that has no data for a dataset, allocated in the attribute's own dtype
+    so no float64 buffer is built and cast on write: NaN for floating point attributes, 0 otherwise
+    '''
+    dtype=np.dtype(dtype)
+    if np.issubdtype(dtype,np.floating):
+        return np.full(num_entries,np.nan,dtype=dtype)
+    return np.zeros(num_entries,dtype=dtype)
+
 def chunkify(iterable,chunk):
     it=iter(iterable)
     while True:
@@ -111,8 +188,9 @@ def transform_indices_to_chrom_coords(start_chunk_index,end_chunk_index,chrom_in
                     found=True
                     #start position is on this chromosome
                     chrom_coord_start=start_chunk_index-cur_chrom_start_index
-                    #check if end coordinate falls on same chromosome
-                    if end_chunk_index < cur_chrom_end_index:
+                    #check if end coordinate falls on same chromosome; a chunk ending exactly at the chromosome end
+                    #must stop here, otherwise an empty coordinate set is emitted for the next chromosome
+                    if end_chunk_index <= cur_chrom_end_index:
                         #on one chrom
                         chrom_coord_end=end_chunk_index-cur_chrom_start_index
                         chrom_coords.append((chrom,chrom_coord_start,chrom_coord_end,start_chunk_index,end_chunk_index))
@@ -135,9 +213,7 @@ def transform_chrom_size_to_indices(chrom_sizes):
     '''
     start_coord=0
     chrom_indices=OrderedDict() 
-    for index,row in chrom_sizes.iterrows():
-        chrom=row[0]
-        size=row[1]
+    for chrom,size in zip(chrom_sizes.iloc[:,0].tolist(),chrom_sizes.iloc[:,1].tolist()):
         chrom_indices[chrom]=[start_coord,start_coord+size,size]
         start_coord=start_coord+size
     return chrom_indices,start_coord
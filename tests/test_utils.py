@@ -0,0 +1,120 @@
+#unit tests for helper functions in seqdataloader.utils
+import pandas as pd
+from seqdataloader.utils import *
+
+chrom_sizes=pd.DataFrame([['chr1',100],['chr2',50],['chr3',30]])
+
+def get_chunk_coords(write_chunk):
+    chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
+    coords=[]
+    for start_chunk_index in range(0,num_indices,write_chunk):
+        end_chunk_index=min([start_chunk_index+write_chunk,num_indices])
+        coords+=transform_indices_to_chrom_coords(start_chunk_index,end_chunk_index,chrom_indices)
+    return coords,num_indices
+
+def test_chunk_ending_at_chrom_end_stays_on_that_chrom():
+    chrom_indices,num_indices=transform_chrom_size_to_indices(chrom_sizes)
+    #chunk 100-150 ends exactly at the end of chr2
+    assert transform_indices_to_chrom_coords(100,150,chrom_indices)==[('chr2',0,50,100,150)]
+    #chunk spanning the end of chr1 into chr2 stops at the chunk end
+    assert transform_indices_to_chrom_coords(50,150,chrom_indices)==[('chr1',50,100,50,100),('chr2',0,50,100,150)]
+
+def test_chunks_have_no_empty_coord_sets():
+    for write_chunk in [1,7,30,50,100,180,1000]:
+        coords,num_indices=get_chunk_coords(write_chunk)
+        for chrom,chrom_start,chrom_end,start_index,end_index in coords:
+            assert chrom_end>chrom_start
+            assert end_index>start_index
+
+def test_chunks_cover_all_indices_once():
+    for write_chunk in [1,7,30,50,100,180,1000]:
+        coords,num_indices=get_chunk_coords(write_chunk)
+        covered=[]
+        for chrom,chrom_start,chrom_end,start_index,end_index in coords:
+            assert end_index-start_index==chrom_end-chrom_start
+            covered+=list(range(start_index,end_index))
+        assert covered==list(range(num_indices))
+
+def test_parse_all_attributes_parses_shared_source_once():
+    calls=[]
+    def counting_parser(entry):
+        calls.append(entry[0])
+        return entry[2],entry[3],np.ones(entry[3]-entry[2])
+    #separate but equal config dicts, as produced by copying an attribute config
+    peak_config={'dtype':'uint8','parser':counting_parser,'store_summits':True,'summit_indicator':2,'summit_from_peak_center':False}
+    attribute_info={'idr_peak':dict(peak_config),
+                    'overlap_peak':dict(peak_config),
+                    'ambig_peak':dict(peak_config,store_summits=False)}
+    data_dict={'idr_peak':'peaks.bed','overlap_peak':'peaks.bed','ambig_peak':'peaks.bed'}
+    vals=parse_all_attributes(data_dict,'chr1',10,20,attribute_info)
+    assert len(calls)==2
+    assert vals['idr_peak'] is vals['overlap_peak']
+    assert vals['ambig_peak'] is not vals['idr_peak']
+    for attribute in vals:
+        assert vals[attribute].dtype==np.uint8
+        assert len(vals[attribute])==10
+
+def naive_expand_intervals(intervals,start,end):
+    signal_data=np.zeros(end-start,dtype=np.float32)
+    for interval_start,interval_end,interval_val in intervals:
+        signal_data[max(interval_start,start)-start:min(interval_end,end)-start]=np.nan_to_num(interval_val)
+    return signal_data
+
+def test_expand_bigwig_intervals_empty():
+    #pybigwig returns None for a range without coverage
+    for intervals in [None,()]:
+        vals=expand_bigwig_intervals(intervals,100,110)
+        assert vals.dtype==np.float32
+        assert np.array_equal(vals,np.zeros(10,dtype=np.float32))
+
+def test_expand_bigwig_intervals_touching_and_gaps():
+    intervals=((100,103,1.0),(103,105,2.0),(107,108,3.0))
+    vals=expand_bigwig_intervals(intervals,100,110)
+    assert np.array_equal(vals,np.array([1,1,1,2,2,0,0,3,0,0],dtype=np.float32))
+
+def test_expand_bigwig_intervals_clipped_to_range():
+    #first and last intervals extend past start and end
+    intervals=((90,102,1.0),(104,106,2.0),(108,120,3.0))
+    vals=expand_bigwig_intervals(intervals,100,110)
+    assert np.array_equal(vals,np.array([1,1,0,0,2,2,0,0,3,3],dtype=np.float32))
+    #a single interval covering the whole range
+    vals=expand_bigwig_intervals(((0,1000,5.0),),100,110)
+    assert np.array_equal(vals,np.full(10,5.0,dtype=np.float32))
+
+def test_expand_bigwig_intervals_nan_values():
+    intervals=((100,102,np.nan),(102,104,4.0))
+    vals=expand_bigwig_intervals(intervals,100,105)
+    assert np.array_equal(vals,np.array([0,0,4,4,0],dtype=np.float32))
+
+def test_expand_bigwig_intervals_matches_naive_fill():
+    rng=np.random.RandomState(0)
+    for trial in range(500):
+        chrom_size=rng.randint(1,300)
+        intervals=[]
+        pos=0
+        while pos<chrom_size:
+            pos+=rng.randint(0,6)
+            interval_end=pos+rng.randint(1,11)
+            intervals.append((pos,interval_end,float(rng.rand()*10)))
+            pos=interval_end
+        start=rng.randint(0,chrom_size)
+        end=rng.randint(start+1,chrom_size+6)
+        #pybigwig returns the intervals overlapping [start,end)
+        overlapping=tuple(i for i in intervals if i[0]<end and i[1]>start)
+        assert np.array_equal(expand_bigwig_intervals(overlapping,start,end),naive_expand_intervals(overlapping,start,end))
+
+def test_parse_bigwig_chrom_vals_matches_values(tmp_path):
+    fname=str(tmp_path/'test.bw')
+    bw=pyBigWig.open(fname,'w')
+    bw.addHeader([('chr1',1000),('chr2',500)])
+    bw.addEntries(['chr1','chr1','chr1'],[10,20,40],ends=[15,30,60],values=[1.5,2.0,3.0])
+    bw.close()
+    bw=pyBigWig.open(fname)
+    #covered ranges, a range on chr1 with no coverage, and chr2 which has no entries at all
+    for chrom,start,end in [('chr1',0,100),('chr1',12,45),('chr1',100,200),('chr2',0,500),('chr2',100,110)]:
+        start_out,end_out,vals=parse_bigwig_chrom_vals([fname,chrom,start,end,{}])
+        assert (start_out,end_out)==(start,end)
+        assert vals.dtype==np.float32
+        assert np.array_equal(vals,np.nan_to_num(np.array(bw.values(chrom,start,end),dtype=np.float32)))
+    bw.close()
+    close_bigwig_handles()